@@ -1,19 +1,24 @@
 import os
+import multiprocessing
 import json
-import time
 import datetime
 import random
 import re
-import requests
+import io
+import html as html_lib
+import asyncio
+import httpx
+import ahocorasick
+from aiolimiter import AsyncLimiter
 import pandas as pd
 import yfinance as yf
 import gspread
 import numpy as np
+from numba import njit
 from oauth2client.service_account import ServiceAccountCredentials
-from concurrent.futures import ThreadPoolExecutor
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from lxml import etree
+from tools.cache import FileCache, ProfileTable
 
 # ==========================================
 # 1. 設定 & 認証周り
@@ -23,6 +28,19 @@ from bs4 import BeautifulSoup
 CONST_NOPAT_RATE = 0.6       # M: NOPAT係数
 CONST_PAYOUT_RATE = 0.4      # N: 擬似配当係数
 CONST_MARKET_YIELD = 0.021   # V: 市場平均配当利回り (2.1%)
+COST_RATIO_THRESHOLD = 1.15  # ①営業費用売上比率の基準値
+COST_RATIO_RELAXED = 1.05    # ①の緩和基準値 (小売・サービス・卸売)
+RELAXED_SECTORS = ["小売業", "サービス業", "卸売業"]
+
+# ディスクキャッシュ (エンドポイント別TTL, 0はキャッシュしない。株価はキャッシュしない)
+CACHE_DIR = ".cache"
+CACHE_TTL_DIVIDEND_DAYS = 7     # 配当性向
+CACHE_TTL_FINANCIALS_DAYS = 7   # 財務諸表・info
+CACHE = FileCache(CACHE_DIR)
+
+# 銘柄名・業種は長期保持 (起動時に読み込み、終了時に保存。期限切れの銘柄は再取得)
+CACHE_TTL_PROFILE_DAYS = 90
+PROFILES = ProfileTable(os.path.join(CACHE_DIR, "sectors.parquet"), CACHE_TTL_PROFILE_DAYS)
 
 # 修正: User-Agentリスト (ランダム化用)
 USER_AGENTS = [
@@ -58,23 +76,90 @@ def connect_gsheet(config):
     worksheet = spreadsheet.worksheet(config["worksheet_name"])
     return worksheet
 
+def flush_sheet_writes(sheet, pending):
+    """溜めた (range, rows) の書き込みを1回のAPI呼び出しでまとめて反映"""
+    if not pending:
+        return
+    try:
+        data = [{"range": range_name, "values": rows} for range_name, rows in pending]
+        sheet.batch_update(data, value_input_option="RAW")
+    except Exception as e:
+        print(f"Sheet Update Error at {pending[0][0]} - {pending[-1][0]}: {e}")
+        # まとめ書きに失敗したらバッチ単位で書き直す (失敗の影響を1バッチ分に留める)
+        for range_name, rows in pending:
+            try:
+                sheet.batch_update([{"range": range_name, "values": rows}], value_input_option="RAW")
+            except Exception as e:
+                print(f"Sheet Update Error at {range_name}: {e}")
+    pending.clear()
+
 # ==========================================
 # 2. スクレイピング & 通信ヘルパー
 # ==========================================
 
-def create_session():
-    """リトライ付きセッション作成"""
-    session = requests.Session()
-    retry = Retry(
-        total=3,
-        backoff_factor=2, # バックオフを少し長めに
-        status_forcelist=(429, 500, 502, 503, 504),
-        allowed_methods=frozenset(["GET"]),
-    )
-    session.mount("https://", HTTPAdapter(max_retries=retry))
-    return session
+# Yahoo JP 非同期取得の設定
+YJ_CONCURRENCY = 16          # 同時に処理する銘柄数
+YJ_CONN_LIMIT = 64           # コネクションプール全体の上限
+YJ_KEEPALIVE_LIMIT = 32      # 維持しておくkeep-alive接続数
+YJ_TIMEOUT = 10              # 1リクエストのタイムアウト(秒)
+YJ_RETRY_TOTAL = 3           # fetch() の再試行回数 (429/5xx・例外時, 指数バックオフ)
+YJ_CONNECT_RETRIES = 1       # 接続失敗時のトランスポート内の即時再試行 (fetch() の試行ごとに掛かるため小さく)
+YJ_RETRY_BACKOFF = 2
+YJ_RETRY_STATUS = (429, 500, 502, 503, 504)
+PARSE_WORKERS = os.cpu_count() or 1   # HTML解析用のプロセス数
+
+# Yahoo JPへのリクエストレート上限 (YJ_RATE_LIMIT 件/秒 のトークンバケット, 全リクエストで共有)
+YJ_RATE_LIMIT = 10
+
+# 株価一括取得の1回あたりの銘柄数 (分析バッチより大きく取る)
+PRICE_CHUNK_SIZE = 500
+
+# 東証33業種
+TSE_SECTORS = [
+    "水産・農林業", "鉱業", "建設業", "食料品", "繊維製品", "パルプ・紙", "化学",
+    "医薬品", "石油・石炭製品", "ゴム製品", "ガラス・土石製品", "鉄鋼", "非鉄金属",
+    "金属製品", "機械", "電気機器", "輸送用機器", "精密機器", "その他製品",
+    "電気・ガス業", "陸運業", "海運業", "空運業", "倉庫・運輸関連業", "情報・通信業",
+    "卸売業", "小売業", "銀行業", "証券、商品先物取引業", "保険業",
+    "その他金融業", "不動産業", "サービス業"
+]
 
-_HTTP_SESSION = create_session()
+def build_sector_automaton(sectors):
+    """業種名のAho-Corasickオートマトンを構築 (1回の走査で全業種を照合)"""
+    automaton = ahocorasick.Automaton()
+    for sec in sectors:
+        automaton.add_word(sec, sec)
+    automaton.make_automaton()
+    return automaton
+
+# HTML解析用のオートマトン・正規表現 (モジュール読み込み時に1回だけ構築)
+SECTOR_AUTOMATON = build_sector_automaton(TSE_SECTORS)
+TITLE_NAME_RE = re.compile(r'(.*?)【')
+TITLE_RE = re.compile(r'<title[^>]*>([^<【]*)【')
+PAYOUT_RE = re.compile(r'<th[^>]*>[^<]*配当性向[^<]*</th>\s*<td[^>]*>(.*?)</td>', re.S)
+TAG_RE = re.compile(r'<[^>]+>')
+
+def fetch_prices(tickers):
+    """全銘柄の直近終値を PRICE_CHUNK_SIZE 件ずつ一括取得して {ticker: price} を返す"""
+    price_cache = {}
+    for start in range(0, len(tickers), PRICE_CHUNK_SIZE):
+        chunk = tickers[start:start + PRICE_CHUNK_SIZE]
+        df_p = None
+        try:
+            # yfinanceのdownloadログを抑制しつつ取得
+            df_p = yf.download(chunk, period="1d", group_by='ticker', threads=min(16, len(chunk)), progress=False)
+        except Exception:
+            pass # ログ抑制
+        for t in chunk:
+            try:
+                if len(chunk) > 1:
+                    price = df_p[t]['Close'].iloc[-1]
+                else:
+                    price = df_p['Close'].iloc[-1]
+                price_cache[t] = float(price)
+            except:
+                price_cache[t] = None
+    return price_cache
 
 def is_market_open():
     """休日判定 (簡易版: 土日のみチェック)"""
@@ -83,103 +168,242 @@ def is_market_open():
         return False, "土日"
     return True, "稼働日"
 
-def get_yahoo_jp_info(ticker_code):
-    """Yahoo!ファイナンス(日本)から情報を取得 (エラー時はNoneを返す)"""
+async def fetch(session, limiter, url, headers=None):
+    """URLを非同期取得してHTML文字列を返す (リトライ付き, 失敗時はNone)"""
+    for attempt in range(YJ_RETRY_TOTAL + 1):
+        try:
+            # 待機はスロットを握ったままの sleep ではなくトークンバケットで行う
+            async with limiter:
+                res = await session.get(url, headers=headers)
+            if res.status_code == 200:
+                return res.text
+            if res.status_code not in YJ_RETRY_STATUS:
+                return None
+        except Exception:
+            pass # ログ抑制
+        if attempt < YJ_RETRY_TOTAL:
+            await asyncio.sleep(YJ_RETRY_BACKOFF * (2 ** attempt))
+    return None
+
+def parse_payout_text(text):
+    """配当性向セルの文字列を数値(%)に変換 (未公表ならNone)"""
+    text = text.strip().replace("%", "")
+    if text and text not in ["-", "---"]:
+        return float(text)
+    return None
+
+def parse_dividend_html(html):
+    """配当ページのHTMLから配当性向(%)を抽出 (取得できなければNone)"""
+    # 高速経路: 生HTMLへの正規表現1回で該当セルを取り出す
+    m = PAYOUT_RE.search(html)
+    if m:
+        return parse_payout_text(html_lib.unescape(TAG_RE.sub("", m.group(1))))
+
+    # 構造が想定と異なる場合のみ lxml で逐次パース (DOM全体は作らず、該当セルで打ち切る)
+    # 見出しセルと同じ行(親要素)の後続 <td> だけを値とみなし、行が閉じたら打ち切る
+    row = None
+    ctx = etree.iterparse(io.BytesIO(html.encode("utf-8")), events=("end",), tag=("th", "td", "tr"),
+                          html=True, encoding="utf-8")
+    for _, el in ctx:
+        if row is not None:
+            if el is row:
+                return None
+            if el.tag == "td" and el.getparent() is row:
+                return parse_payout_text("".join(el.itertext()))
+        elif el.tag == "th" and "配当性向" in "".join(el.itertext()):
+            row = el.getparent()
+        el.clear()
+    return None
+
+def parse_profile_html(html):
+    """プロフィールページのHTMLから (銘柄名, 業種) を抽出 (取得できなければNone)"""
+    name = None
+    # 高速経路: <title> を正規表現で直接読む
+    m = TITLE_RE.search(html)
+    if m:
+        name = html_lib.unescape(m.group(1)).strip()
+    else:
+        # </title> までだけを切り出して読む (本文は見ない)
+        end = html.find("</title>")
+        head = html[:end] if end >= 0 else ""
+        start = head.find("<title")
+        if start >= 0:
+            title = html_lib.unescape(TAG_RE.sub("", head[head.find(">", start) + 1:]))
+            m = TITLE_NAME_RE.search(title)
+            if m: name = m.group(1).strip()
+
+    # DOMのテキスト化はせず、生HTMLをオートマトンで1回だけ走査して業種を判定
+    sector = None
+    for _, sec in SECTOR_AUTOMATON.iter(html):
+        sector = sec
+        break
+    return name, sector
+
+def yj_url(ticker_code, page):
     code_only = str(ticker_code).replace(".T", "")
-    url_div = f"https://finance.yahoo.co.jp/quote/{code_only}.T/dividend"
-    url_prof = f"https://finance.yahoo.co.jp/quote/{code_only}.T/profile"
-    
-    # 修正: User-Agentをランダムに選択
-    headers = {"User-Agent": random.choice(USER_AGENTS)}
-    data = {"payout_ratio": None, "name": str(ticker_code), "sector": "-"}
+    return f"https://finance.yahoo.co.jp/quote/{code_only}.T/{page}"
+
+async def fetch_yahoo_jp_info(session, sem, limiter, parse_pool, ticker_code):
+    """Yahoo!ファイナンス(日本)から配当性向を取得 (銘柄名・業種はキャッシュがあれば併せて返す)"""
+    data = {"payout_ratio": None, "name": str(ticker_code), "sector": "-", "has_profile": False}
 
     try:
-        # 修正: 待機時間を短縮 (0.05〜0.9秒)
-        time.sleep(random.uniform(0.05, 0.9))
+        # 銘柄名・業種は保存済みテーブルのみ参照 (未登録分は判定後に fetch_yahoo_jp_profile で取得)
+        known = PROFILES.get(ticker_code)
+        if known is not None:
+            data["name"], data["sector"] = known
+            data["has_profile"] = True
+
+        # 配当性向
+        cached_div = CACHE.get(ticker_code, "yj_dividend", CACHE_TTL_DIVIDEND_DAYS)
+        if cached_div is not None:
+            data["payout_ratio"] = cached_div["payout_ratio"]
+            return data
+
+        # 修正: User-Agentをランダムに選択
+        headers = {"User-Agent": random.choice(USER_AGENTS)}
+        async with sem:
+            html = await fetch(session, limiter, yj_url(ticker_code, "dividend"), headers)
+
+        # HTML解析はCPU処理のためプロセスプールに逃がす (イベントループを止めず、GILも回避)
+        if html:
+            loop = asyncio.get_running_loop()
+            data["payout_ratio"] = await loop.run_in_executor(parse_pool, parse_dividend_html, html)
+            if data["payout_ratio"] is not None:
+                CACHE.set(ticker_code, "yj_dividend", {"payout_ratio": data["payout_ratio"]}, CACHE_TTL_DIVIDEND_DAYS)
 
-        # 1. 配当性向
-        try:
-            res = _HTTP_SESSION.get(url_div, headers=headers, timeout=10)
-            if res.status_code == 200:
-                soup = BeautifulSoup(res.text, "html.parser")
-                th = soup.find("th", string=re.compile("配当性向"))
-                if th:
-                    td = th.find_next_sibling("td")
-                    if td:
-                        text = td.get_text(strip=True).replace("%", "")
-                        if text and text not in ["-", "---"]:
-                            data["payout_ratio"] = float(text)
-        except:
-            pass # ログ抑制
-        
-        # 2. 銘柄名・業種
-        try:
-            res_prof = _HTTP_SESSION.get(url_prof, headers=headers, timeout=10)
-            if res_prof.status_code == 200:
-                soup = BeautifulSoup(res_prof.text, "html.parser")
-                title_tag = soup.find("title")
-                if title_tag:
-                    m = re.search(r'(.*?)【', title_tag.text)
-                    if m: data["name"] = m.group(1).strip()
-                
-                TSE_SECTORS = [
-                    "水産・農林業", "鉱業", "建設業", "食料品", "繊維製品", "パルプ・紙", "化学",
-                    "医薬品", "石油・石炭製品", "ゴム製品", "ガラス・土石製品", "鉄鋼", "非鉄金属",
-                    "金属製品", "機械", "電気機器", "輸送用機器", "精密機器", "その他製品",
-                    "電気・ガス業", "陸運業", "海運業", "空運業", "倉庫・運輸関連業", "情報・通信業",
-                    "卸売業", "小売業", "銀行業", "証券、商品先物取引業", "保険業",
-                    "その他金融業", "不動産業", "サービス業"
-                ]
-                text_content = soup.get_text()
-                for sec in TSE_SECTORS:
-                    if sec in text_content:
-                        data["sector"] = sec
-                        break
-        except:
-            pass # ログ抑制
+    except:
+        pass # ログ抑制
+
+    return data
+
+async def fetch_yahoo_jp_profile(session, sem, limiter, parse_pool, ticker_code, data):
+    """Yahoo!ファイナンス(日本)のプロフィールから銘柄名・業種を取得して data を更新"""
+    try:
+        headers = {"User-Agent": random.choice(USER_AGENTS)}
+        async with sem:
+            html = await fetch(session, limiter, yj_url(ticker_code, "profile"), headers)
+
+        if html:
+            loop = asyncio.get_running_loop()
+            name, sector = await loop.run_in_executor(parse_pool, parse_profile_html, html)
+            if name: data["name"] = name
+            if sector: data["sector"] = sector
+            if name:
+                data["has_profile"] = True
+                # 業種が取れなかった銘柄は保存せず、次回の実行で再取得する
+                if sector:
+                    PROFILES.set(ticker_code, name, sector)
 
     except:
         pass # ログ抑制
-    
+
     return data
 
+def create_parse_pool():
+    """HTML解析用のプロセスプールを作成 (解析はCPU処理でGILを握るため、コア数分のプロセスで並列化)"""
+    # fork で起動し、子プロセスでのモジュール再読み込みを避ける
+    # (forkは他スレッドが動く前が安全なため、作成直後に全ワーカーを起動しておく)
+    pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("fork"))
+    pool.submit(int).result()
+    return pool
+
+def create_yj_session():
+    """Yahoo JP取得用の HTTP/2 クライアントを作成 (実行全体で1つを使い回す)"""
+    # HTTP/2 で1本の接続に複数リクエストを多重化し、TLSハンドシェイクを減らす
+    limits = httpx.Limits(max_connections=YJ_CONN_LIMIT, max_keepalive_connections=YJ_KEEPALIVE_LIMIT)
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=YJ_CONNECT_RETRIES)
+    # requests と同様にリダイレクトを追う (httpx は既定で追わない)
+    return httpx.AsyncClient(transport=transport, timeout=YJ_TIMEOUT, follow_redirects=True)
+
+async def scrape_all(session, sem, limiter, parse_pool, tickers):
+    """Yahoo JPの配当性向を銘柄まとめて非同期取得し {ticker: yj_data} を返す"""
+    results = await asyncio.gather(*(fetch_yahoo_jp_info(session, sem, limiter, parse_pool, t) for t in tickers))
+    return dict(zip(tickers, results))
+
+async def scrape_profiles(session, sem, limiter, parse_pool, tickers, yj_map):
+    """指定銘柄のみプロフィールを非同期取得し、yj_map を更新"""
+    await asyncio.gather(*(fetch_yahoo_jp_profile(session, sem, limiter, parse_pool, t, yj_map[t]) for t in tickers))
+
 # ==========================================
 # 3. コアロジック
 # ==========================================
 
-def get_value(df, keys, date_col):
-    if df.empty or date_col is None or date_col not in df.columns:
-        return 0
+# yfinance への同時リクエスト数 (Yahoo JPの YJ_CONCURRENCY とは別に制限)
+YF_CONCURRENCY = 8
+
+# 銘柄ごとの yf.Ticker (プロセス内で使い回す)
+_YF_TICKERS = {}
+
+def get_yf_tickers(batch_tickers):
+    """バッチ分の yf.Ticker を yf.Tickers でまとめて生成し {ticker: Ticker} を返す"""
+    missing = [t for t in batch_tickers if t not in _YF_TICKERS]
+    if missing:
+        # yf.Tickers配下のTickerはyfinance内部の共有セッションを使う
+        tks = yf.Tickers(missing)
+        for t in missing:
+            _YF_TICKERS[t] = tks.tickers[t.upper()]
+    return {t: _YF_TICKERS[t] for t in batch_tickers}
+
+def frame_arrays(df):
+    """DataFrameを (値の2次元配列, 行名->行番号の辞書) に変換 (.locのオーバーヘッドを避ける)"""
+    return df.to_numpy(dtype=np.float64), {k: i for i, k in enumerate(df.index)}
+
+def get_row(arr, idx, keys):
+    """keysの行を1回だけ引き、列ごとに最初に見つかった欠損でない値を並べた配列を返す (無ければ0)"""
+    row = np.full(arr.shape[1], np.nan)
     for key in keys:
-        if key in df.index:
-            val = df.loc[key, date_col]
-            if not pd.isna(val):
-                return float(val)
-    return 0
-
-def analyze_stock(ticker, current_price_cache):
-    res = {
-        "B_cost_ratio": None, "C_judge1": "不合格",
-        "D_payout": None, "E_judge2": "不合格",
-        "F_cagr": None, "G_judge3": "不合格",
-        "H_cap": None, "I_shares": None, "J_equity": None, "K_op_income": None, "L_date": None,
-        "M_nopat_k": CONST_NOPAT_RATE, "N_div_k": CONST_PAYOUT_RATE,
-        "O_nopat": None, "P_pseudo_div": None, "Q_pseudo_roe": None,
-        "R_roe_class": None, "S_7y_mult": None, "T_7y_div": None,
-        "U_fut_yield": None, "V_mkt_yield": CONST_MARKET_YIELD,
-        "W_upside": None, "X_price": None, "Y_target": None,
-        "Z_final": "不合格",
-        "AA_name": "", "AB_sector": ""
+        i = idx.get(key)
+        if i is not None:
+            row = np.where(np.isnan(row), arr[i], row)
+    return np.nan_to_num(row, nan=0.0)
+
+def fetch_income_arrays(tk):
+    """損益計算書から必要な行だけを配列で返す (キャッシュはこの形で保存し、DataFrameは初回取得時のみ作る)"""
+    fins = tk.financials
+    if fins is None or fins.empty:
+        return None
+    arr, idx = frame_arrays(fins)
+    return {
+        "dates": np.array([str(pd.Timestamp(d).date()) for d in fins.columns]),
+        "revenue": get_row(arr, idx, ['Total Revenue']),
+        "op_income": get_row(arr, idx, ['Operating Income', 'Operating Profit']),
+    }
+
+def fetch_balance_arrays(tk):
+    """貸借対照表から自己資本の行だけを配列で返す"""
+    bs = tk.balance_sheet
+    if bs is None or bs.empty:
+        return None
+    arr, idx = frame_arrays(bs)
+    return {
+        "dates": np.array([str(pd.Timestamp(d).date()) for d in bs.columns]),
+        "equity": get_row(arr, idx, ['Total Stockholder Equity', 'Total Equity', 'Stockholders Equity']),
     }
 
+# 直近4期の売上高 (新しい順)
+REV_COLS = ["rev0", "rev1", "rev2", "rev3"]
+
+# fetch_raw が返す数値項目 (欠損はNone -> DataFrame化でNaN)
+RAW_NUMERIC_COLS = [
+    "price", "payout", "revenue", "op_income",
+    *REV_COLS,
+    "equity", "cap", "shares",
+]
+
+def new_raw(ticker, yj_data):
+    """入力値が全て欠損の raw を作成"""
+    raw = {"ticker": ticker, "name": yj_data["name"], "sector": yj_data["sector"], "date": None}
+    raw.update({col: None for col in RAW_NUMERIC_COLS})
+    return raw
+
+def fetch_raw(ticker, current_price_cache, yj_data, yf_tickers):
+    """1銘柄分の判定・計算に必要な入力値だけを取得して dict で返す (計算はバッチで一括実行)"""
+    raw = new_raw(ticker, yj_data)
+
     try:
-        # Yahoo JP
-        yj_data = get_yahoo_jp_info(ticker)
-        res["AA_name"] = yj_data["name"]
-        res["AB_sector"] = yj_data["sector"]
-        
-        # yfinance
-        tk = yf.Ticker(ticker)
+        # yfinance (バッチ共有のTickerを使用)
+        tk = yf_tickers[ticker]
         
         # 修正: stock.infoの全廃とfast_infoへの移行
         # info = tk.info or {} # 削除: 全情報取得は重いため廃止
@@ -190,13 +414,13 @@ def analyze_stock(ticker, current_price_cache):
              _ = tk.fast_info.last_price # 試しにアクセスして存在確認
         except Exception as e:
              if "404" in str(e) or "Not Found" in str(e):
-                 return format_result(res) # 即時終了
+                 return raw # 即時終了
 
-        fins = tk.financials
-        bs = tk.balance_sheet
+        # 貸借対照表は Phase 2 でのみ使うため、ここでは取得しない (fetch_phase2_inputs)
+        fins = CACHE.get_or_set_arrays(ticker, "fin", lambda: fetch_income_arrays(tk), CACHE_TTL_FINANCIALS_DAYS)
         
-        if fins.empty or bs.empty:
-            return format_result(res)
+        if fins is None:
+            return raw
 
         # 現在株価 (優先: キャッシュ -> fast_info)
         current_price = current_price_cache.get(ticker)
@@ -206,33 +430,19 @@ def analyze_stock(ticker, current_price_cache):
                 current_price = tk.fast_info.last_price
             except:
                 pass
-        res["X_price"] = current_price
+        raw["price"] = current_price
 
-        dates = fins.columns
-        if len(dates) == 0: return format_result(res)
-        latest_date = dates[0]
+        dates = fins["dates"]
+        if len(dates) == 0: return raw
+        raw["date"] = str(dates[0])
+
+        # 売上高は全期間分の配列 (①と③で共用)
+        revenues = fins["revenue"]
 
-        # --- Phase 1 ---
         # ① 営業費用売上比率
-        revenue = get_value(fins, ['Total Revenue'], latest_date)
-        op_income = get_value(fins, ['Operating Income', 'Operating Profit'], latest_date)
-        cost = revenue - op_income
-        
-        pass_gate1 = False
-        if revenue > 0 and op_income > 0 and cost > 0:
-            ratio = revenue / cost
-            res["B_cost_ratio"] = round(ratio, 2)
-            
-            # --- 例外規定の適用 ---
-            # 基本は 1.15 だが、小売・サービス・卸売は 1.05 に緩和
-            threshold = 1.15
-            if yj_data["sector"] in ["小売業", "サービス業", "卸売業"]:
-                threshold = 1.05
-            
-            if ratio >= threshold:
-                res["C_judge1"] = "合格"
-                pass_gate1 = True
-        
+        raw["revenue"] = float(revenues[0])
+        raw["op_income"] = float(fins["op_income"][0])
+
         # ② 配当性向
         # 修正: スクレイピング優先 -> 失敗時のみinfo取得
         payout = yj_data["payout_ratio"]
@@ -242,141 +452,353 @@ def analyze_stock(ticker, current_price_cache):
         if payout is None:
             # フォールバック: ここでのみ stock.info にアクセス (コスト大だが必須項目のため)
             try:
-                val = tk.info.get("payoutRatio")
+                val = CACHE.get_or_set(ticker, "info_payout", lambda: tk.info.get("payoutRatio"), CACHE_TTL_FINANCIALS_DAYS)
                 if val is not None: payout = val
             except:
                 pass
-            
-        pass_gate2 = False
-        if payout is not None:
-            res["D_payout"] = payout
-            if 0.2 <= payout <= 0.6:
-                res["E_judge2"] = "合格"
-                pass_gate2 = True
-        
+        raw["payout"] = payout
+
         # ③ 増収
-        pass_gate3 = False
-        revs = []
         if len(dates) >= 4:
-            for i in range(4):
-                revs.append(get_value(fins, ['Total Revenue'], dates[i]))
-            if all(r > 0 for r in revs):
-                if revs[0] > revs[1] > revs[2] > revs[3]:
-                    res["G_judge3"] = "合格"
-                    pass_gate3 = True
-                cagr = (revs[0] / revs[3]) ** (1/3) - 1
-                res["F_cagr"] = cagr
-
-        all_gates_passed = pass_gate1 and pass_gate2 and pass_gate3
-        if not all_gates_passed:
-            return format_result(res)
-
-        # --- Phase 2 ---
-        # 修正: fast_infoを使用 (market_cap)
-        cap = None
-        try:
-            cap = tk.fast_info.market_cap
-        except:
-            pass
-            
-        if not cap: return format_result(res)
-        cap = cap / 100000000.0
-        res["H_cap"] = cap
-
-        # 修正: fast_infoを使用 (shares)
-        shares = None
-        try:
-            shares = tk.fast_info.shares
-        except:
-            pass
-            
-        if not shares: return format_result(res)
-        res["I_shares"] = shares
-
-        equity = get_value(bs, ['Total Stockholder Equity', 'Total Equity', 'Stockholders Equity'], bs.columns[0])
-        if equity == 0: return format_result(res)
-        equity = equity / 100000000.0
-        res["J_equity"] = equity
-
-        op_income = op_income / 100000000.0
-        res["K_op_income"] = op_income
-        res["L_date"] = str(latest_date.date())
-
-        nopat = op_income * CONST_NOPAT_RATE
-        res["O_nopat"] = nopat
-        
-        pseudo_div = nopat * CONST_PAYOUT_RATE
-        res["P_pseudo_div"] = pseudo_div
-
-        if equity > 0:
-            pseudo_roe = nopat / equity
-            res["Q_pseudo_roe"] = pseudo_roe
-            
-            roe_val = pseudo_roe
-            mult = 1.5
-            roe_cls = "10%未満"
-            if roe_val >= 0.20:
-                mult = 4.0
-                roe_cls = "20%以上"
-            elif roe_val >= 0.15:
-                mult = 3.0
-                roe_cls = "15-20%"
-            elif roe_val >= 0.10:
-                mult = 2.0
-                roe_cls = "10-15%"
-            
-            res["R_roe_class"] = roe_cls
-            res["S_7y_mult"] = mult
-            
-            fut_div = pseudo_div * mult
-            res["T_7y_div"] = fut_div
-            
-            if cap > 0:
-                fut_yield = fut_div / cap
-                res["U_fut_yield"] = fut_yield
-                upside = fut_yield / CONST_MARKET_YIELD
-                res["W_upside"] = round(upside, 2)
-                
-                if current_price:
-                    target = current_price * upside
-                    res["Y_target"] = round(target, 0)
-                    if upside >= 2.0:
-                        res["Z_final"] = "合格"
+            raw.update(zip(REV_COLS, revenues[:4].tolist()))
 
     except Exception:
         pass # ログ抑制
 
-    return format_result(res)
-
-def format_result(r):
-    row = [
-        r["AA_name"], r["AB_sector"],
-        r["B_cost_ratio"], r["C_judge1"],
-        r["D_payout"], r["E_judge2"],
-        r["F_cagr"], r["G_judge3"],
-        r["X_price"], r["Y_target"], r["Z_final"],
-        r["H_cap"], r["I_shares"], r["J_equity"], r["K_op_income"], r["L_date"],
-        r["M_nopat_k"], r["N_div_k"],
-        r["O_nopat"], r["P_pseudo_div"], r["Q_pseudo_roe"],
-        r["R_roe_class"], r["S_7y_mult"], r["T_7y_div"],
-        r["U_fut_yield"], r["V_mkt_yield"],
-        r["W_upside"]
-    ]
-    cleaned_row = []
-    for x in row:
-        if x is None:
-            cleaned_row.append("")
-            continue
-        if isinstance(x, float):
-            if np.isinf(x) or np.isnan(x):
-                cleaned_row.append("")
-                continue
-        cleaned_row.append(x)
-    return cleaned_row
+    return raw
+
+def fetch_phase2_inputs(ticker, yf_tickers):
+    """Phase 2 用の (時価総額, 発行済株式数, 自己資本) を取得 (取得できなければNone)"""
+    tk = yf_tickers[ticker]
+
+    # 修正: fast_infoを使用 (market_cap)
+    cap = None
+    try:
+        cap = tk.fast_info.market_cap
+    except:
+        pass
+    if not cap: return None, None, None
+
+    # 修正: fast_infoを使用 (shares)
+    shares = None
+    try:
+        shares = tk.fast_info.shares
+    except:
+        pass
+    if not shares: return cap, shares, None
+
+    # 貸借対照表は通過銘柄のみ取得
+    equity = None
+    try:
+        bs = CACHE.get_or_set_arrays(ticker, "bs", lambda: fetch_balance_arrays(tk), CACHE_TTL_FINANCIALS_DAYS)
+        if bs is not None:
+            equity = float(bs["equity"][0])
+    except:
+        pass
+    return cap, shares, equity
+
+def evaluate_gates(df):
+    """Phase 1: 3つの足切り条件をバッチ全体で一括判定 (NumPyの真偽値配列を & で合成)"""
+    revenue = df["revenue"].to_numpy(dtype=np.float64)
+    op_income = df["op_income"].to_numpy(dtype=np.float64)
+    payout = df["payout"].to_numpy(dtype=np.float64)
+    # 直近4期の売上高を (銘柄数, 4) の行列で扱う (新しい順, 欠損は0にして判定から外す)
+    revs = np.nan_to_num(df[REV_COLS].to_numpy(dtype=np.float64), nan=0.0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # ① 営業費用売上比率
+        cost = revenue - op_income
+        valid1 = (revenue > 0) & (op_income > 0) & (cost > 0)
+        ratio = np.where(valid1, revenue / cost, np.nan)
+
+        # ③ 増収 (新しい順に rev0 > rev1 > rev2 > rev3)
+        valid3 = np.all(revs > 0, axis=1)
+        cagr = np.where(valid3, (revs[:, 0] / revs[:, 3]) ** (1/3) - 1, np.nan)
+
+    # --- 例外規定の適用 ---
+    # 基本は 1.15 だが、小売・サービス・卸売は 1.05 に緩和
+    threshold = np.where(df["sector"].isin(RELAXED_SECTORS).to_numpy(), COST_RATIO_RELAXED, COST_RATIO_THRESHOLD)
+    gate1 = valid1 & (ratio >= threshold)
+
+    # ② 配当性向
+    gate2 = (payout >= 0.2) & (payout <= 0.6)
+
+    # 新しい順なので、隣接差が全て負なら毎期増収
+    gate3 = valid3 & np.all(np.diff(revs, axis=1) < 0, axis=1)
+
+    df["ratio"] = ratio
+    df["B_cost_ratio"] = np.round(ratio, 2)
+    df["C_judge1"] = np.where(gate1, "合格", "不合格")
+    df["D_payout"] = payout
+    df["E_judge2"] = np.where(gate2, "合格", "不合格")
+    df["F_cagr"] = cagr
+    df["G_judge3"] = np.where(gate3, "合格", "不合格")
+    df["gate2"] = gate2
+    df["gate3"] = gate3
+    df["passed"] = gate1 & gate2 & gate3
+    return df
+
+# compute_kernel の到達段階 (元の逐次処理でどこまで値が埋まるか)
+LEVEL_CAP, LEVEL_SHARES, LEVEL_EQUITY, LEVEL_ROE, LEVEL_YIELD, LEVEL_TARGET = 1, 2, 3, 4, 5, 6
+
+# 擬似ROEの区分 (np.digitize と同じく ROE_BINS[k-1] <= roe < ROE_BINS[k] を区分kとする)
+ROE_BINS = np.array([0.10, 0.15, 0.20])
+ROE_MULTS = np.array([1.5, 2.0, 3.0, 4.0])   # 区分ごとの7年後配当倍率
+ROE_CLASSES = np.array(["10%未満", "10-15%", "15-20%", "20%以上"], dtype=object)
+
+# パイプラインの分析段(ワーカースレッド)から呼ぶため parallel は使わない
+# (バッチ50件では並列化の利得が無く、TBB等のスレッド層は別スレッドからの起動で終了時に固まることがある)
+# cache=True はローカルでの再実行時にコンパイルを省くためのもの
+# (numbaはソースの更新時刻で判定するため、チェックアウトし直すCIでは毎回コンパイルされる)
+@njit(cache=True)
+def compute_kernel(rows, cap, shares, equity, op_income, price,
+                   nopat_rate, payout_rate, market_yield, roe_bins, roe_mults,
+                   out_level, out_nopat, out_pseudo_div, out_roe, out_roe_class, out_mult,
+                   out_fut_div, out_fut_yield, out_upside, out_target):
+    """Phase 2 の数値計算カーネル (rows の行だけを計算, 欠損はNaN, 金額は億円単位で受け取る)
+
+    出力配列は呼び出し側で初期化しておく (NaN / level=0 / roe_class=-1)。
+    計算定数・ROE区分は引数で受け取り、呼び出し側の値をそのまま使う。
+    """
+    for j in range(rows.shape[0]):
+        i = rows[j]
+        level = np.int64(0)
+
+        # NaN != NaN を利用して欠損を判定
+        if cap[i] == cap[i] and cap[i] != 0.0:
+            level = LEVEL_CAP
+            if shares[i] == shares[i] and shares[i] != 0.0:
+                level = LEVEL_SHARES
+                if equity[i] == equity[i] and equity[i] != 0.0:
+                    level = LEVEL_EQUITY
+                    nopat = op_income[i] * nopat_rate
+                    pseudo_div = nopat * payout_rate
+                    out_nopat[i] = nopat
+                    out_pseudo_div[i] = pseudo_div
+                    if equity[i] > 0.0:
+                        level = LEVEL_ROE
+                        roe = nopat / equity[i]
+                        # np.digitize 相当 (境界は定数なので分岐の少ない比較の列になる)
+                        roe_class = 0
+                        for k in range(roe_bins.shape[0]):
+                            if roe >= roe_bins[k]:
+                                roe_class = k + 1
+                        mult = roe_mults[roe_class]
+                        fut_div = pseudo_div * mult
+                        out_roe[i] = roe
+                        out_roe_class[i] = roe_class
+                        out_mult[i] = mult
+                        out_fut_div[i] = fut_div
+                        if cap[i] > 0.0:
+                            level = LEVEL_YIELD
+                            fut_yield = fut_div / cap[i]
+                            upside = fut_yield / market_yield
+                            out_fut_yield[i] = fut_yield
+                            out_upside[i] = upside
+                            if price[i] == price[i] and price[i] != 0.0:
+                                level = LEVEL_TARGET
+                                out_target[i] = price[i] * upside
+        out_level[i] = level
+
+def compute_phase(df):
+    """Phase 2: 通過銘柄の理論株価をバッチ全体で一括計算 (途中で欠損した銘柄はそこまでの値のみ)"""
+    n = len(df)
+    cap = df["cap"].to_numpy(dtype=np.float64) / 100000000.0
+    shares = df["shares"].to_numpy(dtype=np.float64)
+    equity = df["equity"].to_numpy(dtype=np.float64) / 100000000.0
+    op_income = df["op_income"].to_numpy(dtype=np.float64) / 100000000.0
+    price = df["price"].to_numpy(dtype=np.float64)
+    # Phase 1 を通過した行だけをカーネルで計算 (それ以外は初期値のまま)
+    rows = np.flatnonzero(df["passed"].to_numpy(dtype=np.bool_))
+
+    level = np.zeros(n, dtype=np.int64)
+    roe_class = np.full(n, -1, dtype=np.int64)
+    nopat, pseudo_div, roe, mult, fut_div, fut_yield, upside, target = (np.full(n, np.nan) for _ in range(8))
+    compute_kernel(rows, cap, shares, equity, op_income, price,
+                   CONST_NOPAT_RATE, CONST_PAYOUT_RATE, CONST_MARKET_YIELD, ROE_BINS, ROE_MULTS,
+                   level, nopat, pseudo_div, roe, roe_class, mult, fut_div, fut_yield, upside, target)
+
+    ok_equity = level >= LEVEL_EQUITY
+    ok_roe = level >= LEVEL_ROE
+
+    df["H_cap"] = np.where(level >= LEVEL_CAP, cap, np.nan)
+    df["I_shares"] = np.where(level >= LEVEL_SHARES, shares, np.nan)
+    df["J_equity"] = np.where(ok_equity, equity, np.nan)
+    df["K_op_income"] = np.where(ok_equity, op_income, np.nan)
+    df["L_date"] = df["date"].where(ok_equity)
+    df["O_nopat"] = nopat
+    df["P_pseudo_div"] = pseudo_div
+
+    df["Q_pseudo_roe"] = roe
+    df["R_roe_class"] = np.where(ok_roe, ROE_CLASSES[roe_class.clip(0)], None)
+    df["S_7y_mult"] = mult
+    df["T_7y_div"] = fut_div
+
+    df["U_fut_yield"] = fut_yield
+    df["W_upside"] = np.round(upside, 2)
+    df["Y_target"] = np.round(target, 0)
+    df["Z_final"] = np.where((level >= LEVEL_TARGET) & (upside >= 2.0), "合格", "不合格")
+
+    df["X_price"] = df["price"]
+    df["M_nopat_k"] = CONST_NOPAT_RATE
+    df["N_div_k"] = CONST_PAYOUT_RATE
+    df["V_mkt_yield"] = CONST_MARKET_YIELD
+    df["AA_name"] = df["name"]
+    df["AB_sector"] = df["sector"]
+    return df
+
+def prepare_batch(batch_tickers, current_price_cache, yj_map, yf_tickers):
+    """バッチ分の入力値を取得して Phase 1 判定まで行った DataFrame を返す"""
+    # yfinance の取得は I/O 待ちが中心のため YF_CONCURRENCY 本のスレッドで並行取得
+    raws = []
+    with ThreadPoolExecutor(max_workers=YF_CONCURRENCY) as executor:
+        futures = [executor.submit(fetch_raw, t, current_price_cache, yj_map[t], yf_tickers) for t in batch_tickers]
+        for t, future in zip(batch_tickers, futures):
+            try:
+                raws.append(future.result())
+            except Exception:
+                raws.append(new_raw(t, yj_map[t]))
+
+    df = pd.DataFrame(raws)
+    df[RAW_NUMERIC_COLS] = df[RAW_NUMERIC_COLS].astype(float)
+    return evaluate_gates(df)
+
+def profile_candidates(df, yj_map):
+    """プロフィール未取得のうち、業種で判定が変わり得る銘柄・全条件を通過し得る銘柄を返す
+
+    業種は①の基準値(緩和業種かどうか)にしか効かないため、①の比率が緩和基準値と
+    基準値の間にある銘柄と、②③を通過し①も通過し得る銘柄だけ取得すれば判定結果は変わらない。
+    """
+    unknown = ~df["ticker"].map(lambda t: yj_map[t]["has_profile"]).astype(bool)
+    ratio = df["ratio"]
+    sector_dependent = (ratio >= COST_RATIO_RELAXED) & (ratio < COST_RATIO_THRESHOLD)
+    could_pass = df["gate2"] & df["gate3"] & (ratio >= COST_RATIO_RELAXED)
+    return df.loc[unknown & (sector_dependent | could_pass), "ticker"].tolist()
+
+def apply_profiles(df, yj_map):
+    """取得した銘柄名・業種を反映して Phase 1 を再判定"""
+    df["name"] = df["ticker"].map(lambda t: yj_map[t]["name"])
+    df["sector"] = df["ticker"].map(lambda t: yj_map[t]["sector"])
+    return evaluate_gates(df)
+
+def finish_batch(df, yf_tickers):
+    """通過銘柄の Phase 2 入力値を取得・計算し、シート書き込み用の行リストを返す"""
+    # 通過銘柄のみ時価総額・株式数・自己資本を取得 (並列処理)
+    passed_idx = df.index[df["passed"]]
+    if len(passed_idx) > 0:
+        with ThreadPoolExecutor(max_workers=YF_CONCURRENCY) as executor:
+            inputs = list(executor.map(lambda t: fetch_phase2_inputs(t, yf_tickers), df.loc[passed_idx, "ticker"]))
+        df.loc[passed_idx, "cap"] = np.array([v[0] for v in inputs], dtype=float)
+        df.loc[passed_idx, "shares"] = np.array([v[1] for v in inputs], dtype=float)
+        df.loc[passed_idx, "equity"] = np.array([v[2] for v in inputs], dtype=float)
+
+    df = compute_phase(df)
+
+    return format_rows(df)
+
+# シート(B列〜AB列)の並び順
+OUTPUT_COLUMNS = [
+    "AA_name", "AB_sector",
+    "B_cost_ratio", "C_judge1",
+    "D_payout", "E_judge2",
+    "F_cagr", "G_judge3",
+    "X_price", "Y_target", "Z_final",
+    "H_cap", "I_shares", "J_equity", "K_op_income", "L_date",
+    "M_nopat_k", "N_div_k",
+    "O_nopat", "P_pseudo_div", "Q_pseudo_roe",
+    "R_roe_class", "S_7y_mult", "T_7y_div",
+    "U_fut_yield", "V_mkt_yield",
+    "W_upside"
+]
+
+def format_rows(df):
+    """結果DataFrameをシートの並びに揃え、欠損・無限大を空文字にした行リストへ変換"""
+    out_df = df[OUTPUT_COLUMNS].replace([np.inf, -np.inf], np.nan).astype(object)
+    return out_df.where(out_df.notna(), "").values.tolist()
 
 # ==========================================
-# 4. メイン処理 (バッチ処理化)
+# 4. メイン処理 (パイプライン化)
 # ==========================================
+# 取得(Yahoo JP) -> 分析(yfinance+計算, 必要な銘柄のみプロフィール取得) -> 書き込み(Sheets) の3段を asyncio.Queue でつなぎ、
+# バッチNの取得中にバッチN-1の分析、N-2の書き込みが並行して進むようにする
+
+BATCH_SIZE = 50            # 1バッチの銘柄数
+PIPELINE_QUEUE_SIZE = 2    # 段間キューの上限 (先行しすぎないよう背圧をかける)
+FLUSH_BATCHES = 10         # 10バッチ(500行) ごとにまとめてシートへ反映
+FLUSH_INTERVAL = 60        # もしくは前回の反映からこの秒数が経過したら反映
+
+async def scrape_stage(batches, compute_q, session, sem, limiter, parse_pool):
+    """取得段: バッチごとにYahoo JPの配当性向を非同期取得して分析段へ渡す"""
+    total_tickers = sum(len(batch_tickers) for _, batch_tickers in batches)
+    for start, batch_tickers in batches:
+        print(f"Processing batch: {start + 1} - {start + len(batch_tickers)} / {total_tickers}")
+        yj_map = await scrape_all(session, sem, limiter, parse_pool, batch_tickers)
+        await compute_q.put((start, batch_tickers, yj_map))
+
+        # バッチ間にも少し待機を入れてサーバーを休ませる (待機中も後段は進む)
+        await asyncio.sleep(3)
+    await compute_q.put(None)
+
+async def compute_stage(compute_q, write_q, price_cache, session, sem, limiter, parse_pool):
+    """分析段: yfinance取得と判定・計算を別スレッドで実行し、結果行を書き込み段へ渡す"""
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        while (item := await compute_q.get()) is not None:
+            start, batch_tickers, yj_map = item
+            try:
+                yf_tickers = get_yf_tickers(batch_tickers)
+                df = await loop.run_in_executor(pool, prepare_batch, batch_tickers, price_cache, yj_map, yf_tickers)
+
+                # 銘柄名・業種は通過し得る銘柄のみ取得 (判定に影響しない銘柄はキャッシュ値か初期値のまま)
+                need_profile = profile_candidates(df, yj_map)
+                if need_profile:
+                    await scrape_profiles(session, sem, limiter, parse_pool, need_profile, yj_map)
+                    df = apply_profiles(df, yj_map)
+
+                output_rows = await loop.run_in_executor(pool, finish_batch, df, yf_tickers)
+            except Exception:
+                output_rows = [[""] * len(OUTPUT_COLUMNS) for _ in batch_tickers]
+            await write_q.put((start, output_rows))
+    await write_q.put(None)
+
+async def write_stage(write_q, sheet):
+    """書き込み段: 結果を溜めて FLUSH_BATCHES 件 / FLUSH_INTERVAL 秒ごとにまとめて反映"""
+    loop = asyncio.get_running_loop()
+    pending_writes = []
+    last_flush = loop.time()
+    try:
+        while (item := await write_q.get()) is not None:
+            start, output_rows = item
+            # 書き込み開始行: ヘッダ(1行) + 既に処理した行数 + 1(1-based index) => start + 2
+            start_row = start + 2
+            end_row = start_row + len(output_rows) - 1
+            pending_writes.append((f"B{start_row}:AB{end_row}", output_rows))
+            if len(pending_writes) >= FLUSH_BATCHES or loop.time() - last_flush >= FLUSH_INTERVAL:
+                await loop.run_in_executor(None, flush_sheet_writes, sheet, pending_writes)
+                last_flush = loop.time()
+
+        # 残りの書き込みを反映
+        await loop.run_in_executor(None, flush_sheet_writes, sheet, pending_writes)
+    finally:
+        # 他の段の例外でキャンセルされた場合も、溜めた行は捨てずに反映する (キャンセル中のため同期で実行)
+        flush_sheet_writes(sheet, pending_writes)
+
+async def run_pipeline(tickers, price_cache, sheet):
+    """3段のパイプラインを起動して全バッチを処理"""
+    batches = [(i, tickers[i:i + BATCH_SIZE]) for i in range(0, len(tickers), BATCH_SIZE)]
+    compute_q = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    write_q = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    # Yahoo JPのクライアント・同時実行数・レート制限・HTML解析用プロセスプールは取得段・分析段(プロフィール取得)で共有
+    # (セマフォとリミッタはイベントループに紐づくため、実行ごとにここで作る)
+    sem = asyncio.Semaphore(YJ_CONCURRENCY)
+    limiter = AsyncLimiter(YJ_RATE_LIMIT, 1)
+    with create_parse_pool() as parse_pool:
+        async with create_yj_session() as session:
+            await asyncio.gather(
+                scrape_stage(batches, compute_q, session, sem, limiter, parse_pool),
+                compute_stage(compute_q, write_q, price_cache, session, sem, limiter, parse_pool),
+                write_stage(write_q, sheet),
+            )
 
 def main():
     open_flg, reason = is_market_open()
@@ -415,74 +837,17 @@ def main():
     total_tickers = len(tickers)
     print(f"Total Tickers: {total_tickers}")
     
-    # --- バッチ処理ロジック ---
-    # 2800銘柄を 50件ずつの塊(Batch)にして処理・書き込みを行う
-    BATCH_SIZE = 50
-    
-    # 全体の処理インデックス
-    current_index = 0
-
-    while current_index < total_tickers:
-        # 今回処理するバッチの範囲
-        end_index = min(current_index + BATCH_SIZE, total_tickers)
-        batch_tickers = tickers[current_index:end_index]
-        
-        print(f"Processing batch: {current_index + 1} - {end_index} / {total_tickers}")
+    # 全銘柄の株価を先に一括取得 (分析バッチとは独立した大きめの塊で取得)
+    price_cache = fetch_prices(tickers)
 
-        # 1. バッチ分の株価一括取得
-        price_cache = {}
-        try:
-            # yfinanceのdownloadログを抑制しつつ取得
-            df_p = yf.download(batch_tickers, period="1d", group_by='ticker', threads=True, progress=False)
-            for t in batch_tickers:
-                try:
-                    if len(batch_tickers) > 1:
-                        price = df_p[t]['Close'].iloc[-1]
-                    else:
-                        price = df_p['Close'].iloc[-1]
-                    price_cache[t] = float(price)
-                except:
-                    price_cache[t] = None
-        except Exception:
-            pass # ログ抑制
-
-        # 2. バッチ分の分析 (並列処理)
-        # サーバー負荷を考慮し workers は少なめに維持
-        batch_results = {}
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            futures = {executor.submit(analyze_stock, t, price_cache): t for t in batch_tickers}
-            
-            for future in futures:
-                t = futures[future]
-                try:
-                    res_list = future.result()
-                    batch_results[t] = res_list
-                except Exception:
-                    batch_results[t] = [""] * 27
-
-        # 3. バッチ分の結果を整形
-        output_rows = []
-        for t in batch_tickers:
-            output_rows.append(batch_results.get(t, [""] * 27))
-
-        # 4. スプレッドシートへ追記書き込み
-        # 書き込み開始行: ヘッダ(1行) + 既に処理した行数 + 1(1-based index) => current_index + 2
-        start_row = current_index + 2
-        end_row = start_row + len(output_rows) - 1
-        range_name = f"B{start_row}:AB{end_row}"
-        
-        try:
-            sheet.update(range_name=range_name, values=output_rows)
-            # API制限回避のための待機
-            time.sleep(2) 
-        except Exception as e:
-            print(f"Sheet Update Error at batch {current_index}: {e}")
-
-        # 次のバッチへ
-        current_index += BATCH_SIZE
-        
-        # バッチ間にも少し待機を入れてサーバーを休ませる
-        time.sleep(3)
+    # --- バッチ処理ロジック ---
+    # 2800銘柄を 50件ずつの塊(Batch)にして 取得・分析・書き込み をパイプラインで処理
+    PROFILES.load()
+    try:
+        asyncio.run(run_pipeline(tickers, price_cache, sheet))
+    finally:
+        # 新たに取得した銘柄名・業種を保存
+        PROFILES.save()
 
     print("All processing completed.")
 
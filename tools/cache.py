@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+
+def write_atomic(path, write_fn):
+    """一時ファイルに書いてから置き換える (並列書き込みでも壊れたファイルを残さない)"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{time.time_ns()}.tmp"
+    try:
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+class FileCache:
+    """銘柄・エンドポイント単位のファイルキャッシュ (TTL付き)
+
+    .cache/{ticker}/{endpoint}.json に {"ts": epoch, "data": ...} 形式で保存する。
+    数値配列は .cache/{ticker}/{endpoint}.npz に保存し、更新時刻でTTLを判定する。
+    ttl_days=0 のエンドポイントはキャッシュしない。
+    """
+
+    def __init__(self, root=".cache", ttl_days=7):
+        self.root = root
+        self.ttl_days = ttl_days
+
+    def _path(self, ticker, endpoint, ext):
+        return os.path.join(self.root, str(ticker), f"{endpoint}.{ext}")
+
+    def _ttl_seconds(self, ttl_days):
+        if ttl_days is None:
+            ttl_days = self.ttl_days
+        return ttl_days * 86400
+
+    # --- JSON ---
+
+    def get(self, ticker, endpoint, ttl_days=None):
+        """有効期限内のキャッシュを返す (無い・期限切れ・壊れている場合はNone)"""
+        ttl = self._ttl_seconds(ttl_days)
+        if ttl <= 0:
+            return None
+        path = self._path(ticker, endpoint, "json")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            if time.time() - entry["ts"] > ttl:
+                return None
+            return entry["data"]
+        except Exception:
+            return None
+
+    def set(self, ticker, endpoint, data, ttl_days=None):
+        if data is None or self._ttl_seconds(ttl_days) <= 0:
+            return
+        entry = {"ts": time.time(), "data": data}
+
+        def write(tmp_path):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+
+        try:
+            write_atomic(self._path(ticker, endpoint, "json"), write)
+        except Exception:
+            pass # キャッシュ書き込み失敗は無視
+
+    def get_or_set(self, ticker, endpoint, fetch, ttl_days=None):
+        """キャッシュがあれば返し、無ければ fetch() の結果を保存して返す (Noneは保存しない)"""
+        data = self.get(ticker, endpoint, ttl_days)
+        if data is not None:
+            return data
+        data = fetch()
+        self.set(ticker, endpoint, data, ttl_days)
+        return data
+
+    # --- NumPy配列 (npz) ---
+
+    def get_arrays(self, ticker, endpoint, ttl_days=None):
+        """有効期限内のキャッシュを {名前: ndarray} で返す (無い・期限切れ・壊れている場合はNone)"""
+        ttl = self._ttl_seconds(ttl_days)
+        if ttl <= 0:
+            return None
+        path = self._path(ticker, endpoint, "npz")
+        try:
+            if time.time() - os.path.getmtime(path) > ttl:
+                return None
+            with np.load(path) as z:
+                return {k: z[k] for k in z.files}
+        except Exception:
+            return None
+
+    def set_arrays(self, ticker, endpoint, arrays, ttl_days=None):
+        if not arrays or self._ttl_seconds(ttl_days) <= 0:
+            return
+
+        def write(tmp_path):
+            # ファイル名を渡すと拡張子 .npz が付け足されるため、ファイルオブジェクトに書く
+            with open(tmp_path, "wb") as f:
+                np.savez_compressed(f, **arrays)
+
+        try:
+            write_atomic(self._path(ticker, endpoint, "npz"), write)
+        except Exception:
+            pass # キャッシュ書き込み失敗は無視
+
+    def get_or_set_arrays(self, ticker, endpoint, fetch, ttl_days=None):
+        arrays = self.get_arrays(ticker, endpoint, ttl_days)
+        if arrays is not None:
+            return arrays
+        arrays = fetch()
+        self.set_arrays(ticker, endpoint, arrays, ttl_days)
+        return arrays
+
+class ProfileTable:
+    """銘柄名・業種の永続テーブル (ほぼ変わらないため長めの期限で保持)
+
+    起動時に parquet を1回読み込み、新たに取得した銘柄を追記して終了時に保存する。
+    コードの再利用や業種変更に追従するため、ttl_days を過ぎた行は未登録として扱い再取得させる。
+    """
+
+    COLUMNS = ["ticker", "name", "sector", "ts"]
+
+    def __init__(self, path, ttl_days=90):
+        self.path = path
+        self.ttl_days = ttl_days
+        self._rows = {}
+        self._dirty = False
+
+    def load(self):
+        try:
+            df = pd.read_parquet(self.path)
+            if "ts" not in df.columns:
+                df["ts"] = 0.0 # 取得時刻の無い旧形式は期限切れ扱い
+            df = df[self.COLUMNS]
+            self._rows = {t: (name, sector, ts) for t, name, sector, ts in df.itertuples(index=False)}
+        except Exception:
+            self._rows = {}
+        self._dirty = False
+
+    def get(self, ticker):
+        """(銘柄名, 業種) を返す (未登録・期限切れ・業種不明ならNone)"""
+        row = self._rows.get(ticker)
+        if row is None:
+            return None
+        name, sector, ts = row
+        if not sector or sector == "-" or time.time() - ts > self.ttl_days * 86400:
+            return None
+        return name, sector
+
+    def set(self, ticker, name, sector):
+        self._rows[ticker] = (name, sector, time.time())
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        df = pd.DataFrame(
+            [(t, *row) for t, row in self._rows.items()],
+            columns=self.COLUMNS,
+        )
+        try:
+            write_atomic(self.path, lambda tmp_path: df.to_parquet(tmp_path, compression="zstd", index=False))
+            self._dirty = False
+        except Exception:
+            pass # キャッシュ書き込み失敗は無視